@@ -1,11 +1,22 @@
-import requests
-from bs4 import BeautifulSoup
+import asyncio
+import functools
+import html
+import re
+import httpx
+from aiolimiter import AsyncLimiter
+from selectolax.lexbor import LexborHTMLParser
 import time
+import gzip
+import hashlib
 import json
+import orjson
 import os
 import traceback
+from collections import namedtuple
 from dotenv import load_dotenv
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
 # --- Configuration ---
 load_dotenv() # Load variables from .env file into environment
@@ -17,85 +28,169 @@ DISCORD_USER_ID_TO_PING = os.getenv('DISCORD_USER_ID_TO_PING')
 COURSE_PREFIXES_TO_FETCH = ["cmsc3", "cmsc4"]
 SPECIFIC_3XX_COURSES = ["CMSC320", "CMSC335"]
 TERM_ID = "202601"
-STARRED_COURSES = {
+STARRED_COURSES = frozenset({
     "CMSC320", "CMSC335", "CMSC414", "CMSC417", "CMSC421",
     "CMSC424", "CMSC430", "CMSC433", "CMSC434", "CMSC435", "CMSC436"
-}
+})
 COURSES_TO_EXCLUDE = ["CMSC498A", "CMSC499A"]
 
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
 SOC_SEARCH_URL_TEMPLATE = "https://app.testudo.umd.edu/soc/search?courseId={prefix}&sectionId=&termId={term_id}&creditCompare=&credits=&courseLevelFilter=ALL&instructor=&_facetoface=on&_blended=on&_online=on&courseStartCompare=&courseStartHour=&courseStartMin=&courseStartAM=&courseEndHour=&courseEndMin=&courseEndAM=&teachingCenter=ALL&_classDay1=on&_classDay2=on&_classDay3=on&_classDay4=on&_classDay5=on"
 SOC_SECTION_URL_TEMPLATE = "https://app.testudo.umd.edu/soc/{term_id}/sections?courseIds={course_id}"
+SOC_COURSE_URL_TEMPLATE = "https://app.testudo.umd.edu/soc/{term_id}/{dept}/{course_id}"
+
+# CSS selectors used when walking Testudo pages (defined once, reused for every node)
+COURSE_SEL = "div.course"; COURSE_ID_INPUT_SEL = 'input[name="courseId"]'; COURSE_TITLE_SEL = "span.course-title"
+SECTIONS_CONTAINER_SEL = "div.sections-container"; SECTION_SEL = "div.section"
+SPAN_SEL = "span"; INSTR_LINK_SEL = "a"
+COURSES_CONTAINER_MARKER = b'class="courses-container"' # Search pages are sliced from here before parsing
+# Span class -> section field; the DOM fallback dispatches each span of a section through this in one walk
+SECTION_SPAN_FIELDS = {"section-id": "sec_id", "open-seats-count": "opn", "total-seats-count": "tot", "waitlist-count": "wl", "section-instructor": "instr"}
+
+# Single-pass regex over the /sections snippet; the DOM walk above is only the fallback
+SECTION_FIELD_RE = re.compile(r'<span class="(section-id|section-instructor|open-seats-count|total-seats-count|waitlist-count)">(.*?)</span>', re.DOTALL)
+SECTION_DIV_RE = re.compile(r'<div class="section[\s"]')
+TAG_RE = re.compile(r'<[^>]+>')
+SECTION_COUNT_FIELD_INDEX = {"open-seats-count": 0, "total-seats-count": 1, "waitlist-count": 2} # Position in Section
 
 SEND_DISCORD_NOTIFICATION = True
 SEND_NO_UPDATES_MESSAGE = True
-SECTION_FETCH_DELAY = 0.5
+SECTION_FETCH_CONCURRENCY = 8 # Max in-flight section requests to Testudo
+SECTION_FETCH_RATE = 10 # Token bucket: section requests allowed per second (bursts allowed, no fixed sleeps)
+HTTP_KEEPALIVE_EXPIRY = 60 # Seconds an idle pooled connection is kept open
+HTTP_CONNECT_RETRIES = 2 # Transport-level retries for failed connection attempts
+DISCORD_MAX_ATTEMPTS = 3 # Per message part; only 429 responses are retried
 PARSE_ERROR_DEFAULT = -999
-
-s3_client = boto3.client('s3')
+# In-memory section record; converted to/from {"open", "total", "waitlist", "instructor"} dicts only at the JSON boundary
+Section = namedtuple('Section', 'open total waitlist instructor')
+STATE_GZIP_LEVEL = 1 # State JSON is very repetitive; level 1 already shrinks it several-fold
+
+s3_client = boto3.client('s3', config=Config(tcp_keepalive=True, max_pool_connections=10, retries={'mode': 'standard'}))
+if S3_BUCKET_NAME and os.getenv('AWS_LAMBDA_FUNCTION_NAME'):
+    # Warm the S3 connection (DNS + TLS) during init so the first state GET of a cold start reuses it
+    try: s3_client.head_bucket(Bucket=S3_BUCKET_NAME)
+    except Exception as e: print(f"S3 warm-up skipped: {e}")
+# Last state loaded from / saved to S3 by this container, keyed by the object's ETag (survives warm invocations)
+_LAST_STATE = None; _LAST_ETAG = None
+_LAST_DIGEST = None # blake2b of the canonical state JSON, mirrored in the object's 'state-digest' metadata
+_DISCORD_READY_AT = 0.0 # time.monotonic() before which the webhook bucket is known to be empty
 
 # --- Helper Functions (fetch_initial_page, fetch_section_details, parse_int_safe, process_course_prefixes) ---
-# (These functions remain identical to the previous version)
-def fetch_initial_page(url):
-    """Fetches a search results page HTML using requests (sync)."""
+def slice_course_list(content):
+    """Drops everything before the courses container (head, scripts, nav) so lexbor builds a much smaller tree.
+    Falls back to the full page if the marker is missing; the tail is kept since lexbor closes any open tags."""
+    marker_pos = content.find(COURSES_CONTAINER_MARKER)
+    if marker_pos < 0: return content
+    start = content.rfind(b'<div', 0, marker_pos)
+    return content[start:] if start >= 0 else content
+
+async def fetch_initial_page(client, url):
+    """Fetches a search results page HTML using the shared httpx client (async)."""
     try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
         print(f"Fetching course list page: {url}")
-        response = requests.get(url, headers=headers, timeout=20)
+        response = await client.get(url, timeout=20)
         response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
-        return soup
-    except requests.exceptions.RequestException as e:
+        tree = LexborHTMLParser(slice_course_list(response.content)) # Raw bytes: lexbor decodes natively, no Python-side str copy
+        return tree
+    except httpx.HTTPError as e:
         print(f"Error fetching URL {url}: {e}")
         return None
     except Exception as parse_e:
         print(f"Error parsing initial page: {parse_e}")
         return None
 
-def fetch_section_details(course_id, term_id, search_url_base):
-    """Fetches section details HTML snippet using requests (sync)."""
+async def fetch_section_details(client, course_id, term_id, search_url_base, semaphore, limiter):
+    """Fetches the raw section details HTML snippet using the shared httpx client (async)."""
     section_url = SOC_SECTION_URL_TEMPLATE.format(term_id=term_id, course_id=course_id)
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        'Referer': search_url_base,
-        'X-Requested-With': 'XMLHttpRequest'
-    }
-    try:
-        response = requests.get(section_url, headers=headers, timeout=25)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
-        return soup
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching sections for {course_id}: {e}")
-        return None
+    headers = {'Referer': search_url_base, 'X-Requested-With': 'XMLHttpRequest'}
+    async with semaphore, limiter:
+        try:
+            response = await client.get(section_url, headers=headers)
+            response.raise_for_status()
+            return response.text
+        except httpx.HTTPError as e:
+            print(f"Error fetching sections for {course_id}: {e}")
+            return None
 
 def parse_int_safe(text, default=PARSE_ERROR_DEFAULT):
-    """Safely converts text to int."""
+    """Safely converts text to int. Plain digit strings (the usual case) skip the comma strip and exception handling."""
     if text is None: return default
-    try:
-        return int(text.strip().replace(',', ''))
-    except (ValueError, TypeError):
-        return default
-
-def process_course_prefixes(prefixes, specific_3xx, excluded, term_id):
-    """Fetches initial pages, filters courses, fetches/parses sections SEQUENTIALLY."""
+    t = text.strip()
+    if t.isdecimal(): return int(t)
+    if ',' in t: t = t.replace(',', '')
+    return int(t) if (t[1:] if t[:1] in '+-' else t).isdecimal() else default
+
+def parse_sections_regex(section_html):
+    """Extracts sections from a /sections snippet in one regex scan.
+    Returns None when the markup doesn't match the expected template, so the caller can fall back to the DOM walk."""
+    parse = parse_int_safe; err = PARSE_ERROR_DEFAULT; tba = "Instructor: TBA"; count_index = SECTION_COUNT_FIELD_INDEX
+    rows = {}; current = None; misses = 0
+    for field, value in SECTION_FIELD_RE.findall(section_html):
+        if field == "section-id":
+            sec_id = value.strip(); current = [err, err, err, tba] # Fields arrive in markup order; frozen into a Section below
+            if sec_id: rows[sec_id] = current
+            else: misses += 1
+        elif current is None: misses += 1
+        elif field == "section-instructor":
+            raw = html.unescape(TAG_RE.sub('', value)).strip()
+            if raw and tba not in raw and current[3] == tba: current[3] = raw
+        elif current[count_index[field]] == err: current[count_index[field]] = parse(value) # First span wins, like find(); e.g. Holdfile reuses waitlist-count
+    misses += sum(1 for row in rows.values() if err in row)
+    if misses or len(rows) != len(SECTION_DIV_RE.findall(section_html)): return None
+    return {sec_id: Section._make(row) for sec_id, row in rows.items()}
+
+def parse_sections_dom(section_html, course_id):
+    """Extracts sections from a /sections snippet by walking the selectolax tree (fallback path)."""
+    parse = parse_int_safe; sections = {}
+    section_tree = LexborHTMLParser(section_html)
+    sections_container = section_tree.css_first(SECTIONS_CONTAINER_SEL); section_divs = (sections_container or section_tree).css(SECTION_SEL)
+    field_map = SECTION_SPAN_FIELDS
+    for section_div in section_divs:
+        spans = {}
+        for span in section_div.css(SPAN_SEL):
+            for cls in (span.attributes.get('class') or '').split():
+                field = field_map.get(cls)
+                if field and field not in spans: spans[field] = span; break # First match per field, like css_first
+        get = spans.get; sec_id_span = get("sec_id"); opn_span = get("opn"); tot_span = get("tot"); wl_span = get("wl"); instr_span = get("instr")
+        sec_id = sec_id_span.text().strip() if sec_id_span else None; instr = "Instructor: TBA"; raw = None
+        if instr_span: link = instr_span.css_first(INSTR_LINK_SEL); raw = (link or instr_span).text().strip()
+        if raw and "Instructor: TBA" not in raw: instr = raw
+        opn = parse(opn_span.text() if opn_span else None); tot = parse(tot_span.text() if tot_span else None); wl = parse(wl_span.text() if wl_span else None)
+        if sec_id: sections[sec_id] = Section(opn, tot, wl, instr)
+        else: print(f"   -> Could not find section_id span for {course_id}")
+    return sections
+
+async def fetch_course_sections(client, course_id, title, term_id, search_url_base, semaphore, limiter):
+    """Fetches one course's sections and parses them as soon as the response arrives,
+    so parsing overlaps the other fetches still in flight instead of waiting for the whole batch."""
+    section_html = await fetch_section_details(client, course_id, term_id, search_url_base, semaphore, limiter)
+    if section_html is None: print(f" -> FETCH ERROR for {course_id}. Marking as error."); return {"title": title, "fetch_error": True}
+    print(f"Processing: {course_id}")
+    sections = parse_sections_regex(section_html)
+    if sections is None: print(f" -> Regex pass missed sections for {course_id}; falling back to DOM parse."); sections = parse_sections_dom(section_html, course_id)
+    if not sections: print(f" -> No section divs found in snippet for {course_id}")
+    return {"title": title, "sections": sections}
+
+async def process_course_prefixes(client, prefixes, specific_3xx, excluded, term_id):
+    """Fetches initial pages, filters courses, fetches sections CONCURRENTLY (on the shared client) and parses them."""
     all_courses_data = {}
     courses_to_process = {}
-    print(f"Processing prefixes sequentially: {', '.join(prefixes)}")
-    for prefix in prefixes:
-        search_url = SOC_SEARCH_URL_TEMPLATE.format(prefix=prefix, term_id=term_id)
-        initial_soup = fetch_initial_page(search_url)
-        if not initial_soup: continue
-        course_divs = initial_soup.find_all('div', class_='course')
+    print(f"Processing prefixes concurrently: {', '.join(prefixes)}")
+    search_urls = [SOC_SEARCH_URL_TEMPLATE.format(prefix=prefix, term_id=term_id) for prefix in prefixes]
+    initial_trees = await asyncio.gather(*[fetch_initial_page(client, url) for url in search_urls])
+    for prefix, initial_tree in zip(prefixes, initial_trees):
+        if not initial_tree: continue
+        course_divs = initial_tree.css(COURSE_SEL)
         if not course_divs: continue
         print(f"Found {len(course_divs)} course divs for prefix {prefix}.")
         for course_div in course_divs:
             course_id = None; course_title = "Unknown Title"; course_div_id = None
-            course_id_input = course_div.find('input', {'name': 'courseId'})
-            if course_id_input and course_id_input.get('value'): course_id = course_id_input['value']
-            else: course_div_id = course_div.get('id');
+            course_id_input = course_div.css_first(COURSE_ID_INPUT_SEL)
+            if course_id_input and course_id_input.attributes.get('value'): course_id = course_id_input.attributes['value']
+            else: course_div_id = course_div.attributes.get('id');
             if course_div_id: course_id = course_div_id
-            title_span = course_div.find('span', class_='course-title')
-            if title_span: course_title = title_span.text.strip()
+            title_span = course_div.css_first(COURSE_TITLE_SEL)
+            if title_span: course_title = title_span.text().strip()
             if not course_id: continue
             is_relevant = False
             if course_id in excluded: continue
@@ -104,79 +199,128 @@ def process_course_prefixes(prefixes, specific_3xx, excluded, term_id):
             if is_relevant: courses_to_process[course_id] = course_title
     if not courses_to_process: return {}
     num_courses = len(courses_to_process); print(f"\nCollected {num_courses} relevant course IDs: {', '.join(courses_to_process.keys())}")
-    count = 0; search_url_base = SOC_SEARCH_URL_TEMPLATE.format(prefix=prefixes[0], term_id=term_id).split('?')[0]
-    for course_id, title in courses_to_process.items():
-        count += 1; print(f"Processing: {course_id} ({count}/{num_courses})")
-        all_courses_data[course_id] = {"title": title, "sections": {}}
-        section_soup = fetch_section_details(course_id, term_id, search_url_base)
-        if not section_soup: print(f" -> FETCH ERROR for {course_id}. Marking as error."); all_courses_data[course_id] = {"title": title, "fetch_error": True}; time.sleep(SECTION_FETCH_DELAY); continue
-        sections_container = section_soup.find('div', class_='sections-container'); section_divs = sections_container.find_all('div', class_='section') if sections_container else section_soup.find_all('div', class_='section')
-        if not section_divs: print(f" -> No section divs found in snippet for {course_id}")
-        else:
-            for section_div in section_divs:
-                sec_id_span = section_div.find('span', class_='section-id'); opn_span = section_div.find('span', class_='open-seats-count'); tot_span = section_div.find('span', class_='total-seats-count'); wl_span = section_div.find('span', class_='waitlist-count'); instr_span = section_div.find('span', class_='section-instructor')
-                sec_id = sec_id_span.text.strip() if sec_id_span else None; instr = "Instructor: TBA"
-                if instr_span: link = instr_span.find('a'); raw = link.text.strip() if link else instr_span.text.strip();
-                if raw and "Instructor: TBA" not in raw and raw.strip(): instr = raw
-                opn = parse_int_safe(opn_span.text if opn_span else None); tot = parse_int_safe(tot_span.text if tot_span else None); wl = parse_int_safe(wl_span.text if wl_span else None)
-                if sec_id: all_courses_data[course_id]["sections"][sec_id] = {"open": opn, "total": tot, "waitlist": wl, "instructor": instr}
-                else: print(f"   -> Could not find section_id span for {course_id}")
-        time.sleep(SECTION_FETCH_DELAY)
+    search_url_base = search_urls[0].split('?')[0]
+    semaphore = asyncio.Semaphore(SECTION_FETCH_CONCURRENCY); limiter = AsyncLimiter(SECTION_FETCH_RATE, 1)
+    print(f"Fetching sections for {num_courses} courses (concurrency {SECTION_FETCH_CONCURRENCY}, {SECTION_FETCH_RATE} req/s)...")
+    tasks = [fetch_course_sections(client, course_id, title, term_id, search_url_base, semaphore, limiter) for course_id, title in courses_to_process.items()]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for (course_id, title), course_data in zip(courses_to_process.items(), results):
+        if isinstance(course_data, BaseException):
+            print(f" -> Unexpected error processing {course_id}: {course_data!r}. Marking as error."); course_data = {"title": title, "fetch_error": True}
+        all_courses_data[course_id] = course_data
     return all_courses_data
 
 # --- S3 State Management ---
+def _section_to_json(obj):
+    if isinstance(obj, Section): return obj._asdict()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+def encode_state(data):
+    """Serializes state to JSON bytes, writing each Section as a field-name dict."""
+    return orjson.dumps(data, default=_section_to_json, option=orjson.OPT_SORT_KEYS) # Sorted so equal states give equal bytes/digests
+
+def decode_state(raw):
+    """Parses JSON state bytes, turning each section dict back into a Section."""
+    state_data = orjson.loads(raw)
+    for course_data in state_data.values():
+        sections = course_data.get("sections")
+        if sections:
+            course_data["sections"] = {sec_id: Section(d.get("open", PARSE_ERROR_DEFAULT), d.get("total", PARSE_ERROR_DEFAULT), d.get("waitlist", PARSE_ERROR_DEFAULT), d.get("instructor", "Unknown"))
+                                       for sec_id, d in sections.items()}
+    return state_data
+
+def state_digest(raw):
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
 def load_previous_state_s3():
+    global _LAST_STATE, _LAST_ETAG, _LAST_DIGEST
     if not S3_BUCKET_NAME: print("S3_BUCKET_NAME not set."); return {}
     try:
-        print(f"Loading state from s3://{S3_BUCKET_NAME}/{STATE_FILE_KEY}"); response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=STATE_FILE_KEY)
-        state_data = json.loads(response['Body'].read().decode('utf-8')); print("State loaded from S3."); return state_data
-    except s3_client.exceptions.NoSuchKey: print(f"State file '{STATE_FILE_KEY}' not found in S3."); return {}
-    except Exception as e: print(f"Error loading state from S3: {e}"); traceback.print_exc(); return {}
+        print(f"Loading state from s3://{S3_BUCKET_NAME}/{STATE_FILE_KEY}")
+        # Conditional GET: S3 answers 304 (no body) if the object still has the ETag this warm container last saw
+        get_kwargs = {'IfNoneMatch': _LAST_ETAG} if _LAST_ETAG is not None else {}
+        try: response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=STATE_FILE_KEY, **get_kwargs)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('304', 'NotModified'): raise
+            print("State unchanged in S3 since last invocation; reusing cached copy."); return _LAST_STATE
+        body = response['Body'].read()
+        if response.get('ContentEncoding') == 'gzip': body = gzip.decompress(body) # Older uncompressed state objects are read as-is
+        state_data = decode_state(body); print("State loaded from S3.")
+        _LAST_STATE = state_data; _LAST_ETAG = response.get('ETag'); _LAST_DIGEST = response.get('Metadata', {}).get('state-digest'); return state_data
+    except s3_client.exceptions.NoSuchKey:
+        print(f"State file '{STATE_FILE_KEY}' not found in S3."); _LAST_STATE = _LAST_ETAG = _LAST_DIGEST = None; return {} # Cache must not outlive the object
+    except Exception as e:
+        print(f"Error loading state from S3: {e}"); traceback.print_exc(); _LAST_STATE = _LAST_ETAG = _LAST_DIGEST = None; return {}
 
 def save_current_state_s3(data):
+    global _LAST_STATE, _LAST_ETAG, _LAST_DIGEST
     if not S3_BUCKET_NAME: print("S3_BUCKET_NAME not set."); return False
     try:
-        print(f"Saving state to s3://{S3_BUCKET_NAME}/{STATE_FILE_KEY}"); s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=STATE_FILE_KEY, Body=json.dumps(data, indent=2), ContentType='application/json')
+        raw = encode_state(data); digest = state_digest(raw)
+        if digest == _LAST_DIGEST: print("State identical to the stored copy; skipping S3 PUT."); _LAST_STATE = data; return True
+        print(f"Saving state to s3://{S3_BUCKET_NAME}/{STATE_FILE_KEY}"); body = gzip.compress(raw, compresslevel=STATE_GZIP_LEVEL)
+        response = s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=STATE_FILE_KEY, Body=body, ContentEncoding='gzip', ContentType='application/json', Metadata={'state-digest': digest})
+        _LAST_STATE = data; _LAST_ETAG = response.get('ETag'); _LAST_DIGEST = digest
         print("State saved to S3."); return True
     except Exception as e: print(f"Error saving state to S3: {e}"); traceback.print_exc(); return False
 
 # --- Comparison ---
-# (compare_states remains identical, it correctly identifies *what* changed)
+def flatten_sections(state, course_ids):
+    """Maps (course_id, section_id) -> Section for the given courses, so whole states diff with key-set operations."""
+    return {(course_id, section_id): section_data for course_id in course_ids for section_id, section_data in state[course_id].get("sections", {}).items()}
+
 def compare_states(old_state, new_state):
-    """Compares states, returns list of change dicts for relevant changes."""
-    changes = []; default_section = {"open": PARSE_ERROR_DEFAULT, "total": PARSE_ERROR_DEFAULT, "waitlist": PARSE_ERROR_DEFAULT, "instructor": "Unknown"}
-    for course_id, new_course_data in new_state.items():
-        if new_course_data.get("fetch_error"): continue
-        new_title = new_course_data.get("title", "Unknown"); new_sections = new_course_data.get("sections", {})
-        if course_id not in old_state:
-            change_type = "NEW_CMSC4_COURSE" if course_id.startswith("CMSC4") else "NEW_COURSE_SECTION"
-            for section_id, section_data in new_sections.items(): changes.append({"type": change_type,"course": course_id,"title": new_title,"section": section_id,"data": section_data}); continue
-        old_course_data = old_state.get(course_id, {}); old_sections = old_course_data.get("sections", {})
-        for section_id, new_section_data in new_sections.items():
-            if section_id not in old_sections: changes.append({"type": "NEW_SECTION","course": course_id,"title": new_title,"section": section_id,"data": new_section_data})
-            else:
-                old_section_data = old_sections.get(section_id, default_section)
-                old_open = old_section_data.get("open", PARSE_ERROR_DEFAULT); new_open = new_section_data.get("open", PARSE_ERROR_DEFAULT)
-                if old_open == 0 and new_open > 0: changes.append({"type": "SEATS_OPENED","course": course_id,"title": new_title,"section": section_id,"data": new_section_data, "old_val": old_open, "new_val": new_open, "field": "open"})
-                elif old_open != new_open and new_open != PARSE_ERROR_DEFAULT and old_open != PARSE_ERROR_DEFAULT: changes.append({"type": "OPEN_CHANGE","course": course_id,"title": new_title,"section": section_id,"data": new_section_data, "old_val": old_open, "new_val": new_open, "field": "open"})
-                old_total = old_section_data.get("total", PARSE_ERROR_DEFAULT); new_total = new_section_data.get("total", PARSE_ERROR_DEFAULT)
-                if old_total != new_total and new_total != PARSE_ERROR_DEFAULT and old_total != PARSE_ERROR_DEFAULT: changes.append({"type": "TOTAL_CHANGE","course": course_id,"title": new_title,"section": section_id,"data": new_section_data, "old_val": old_total, "new_val": new_total, "field": "total"})
-                old_wait = old_section_data.get("waitlist", PARSE_ERROR_DEFAULT); new_wait = new_section_data.get("waitlist", PARSE_ERROR_DEFAULT)
-                if old_wait != new_wait and new_wait != PARSE_ERROR_DEFAULT and old_wait != PARSE_ERROR_DEFAULT: changes.append({"type": "WAITLIST_CHANGE","course": course_id,"title": new_title,"section": section_id,"data": new_section_data, "old_val": old_wait, "new_val": new_wait, "field": "waitlist"})
-                old_instr = old_section_data.get("instructor", "Unknown"); new_instr = new_section_data.get("instructor", "TBA")
-                if old_instr != new_instr and old_instr != "Unknown": changes.append({"type": "INSTR_CHANGE","course": course_id,"title": new_title,"section": section_id,"data": new_section_data, "old_val": old_instr, "new_val": new_instr, "field": "instructor"})
-    for course_id, old_course_data in old_state.items():
-        if course_id in new_state and not new_state[course_id].get("fetch_error"):
-            old_sections = old_course_data.get("sections", {}); new_sections = new_state[course_id].get("sections", {})
-            for section_id, old_section_data in old_sections.items():
-                if section_id not in new_sections: changes.append({"type": "SECTION_REMOVED", "course": course_id, "title": old_course_data.get("title", "Unknown"), "section": section_id, "data": old_section_data})
+    """Compares states, returns list of change dicts for relevant changes.
+    Both states are flattened to (course, section) -> Section maps and walked in insertion order (so changes come out
+    in course/section order); only sections whose tuples differ get the per-field comparison."""
+    changes = []; append = changes.append; err = PARSE_ERROR_DEFAULT
+    old_keys = old_state.keys(); new_titles = {cid: data.get("title", "Unknown") for cid, data in new_state.items() if not data.get("fetch_error")}
+    old_flat = flatten_sections(old_state, old_keys); new_flat = flatten_sections(new_state, new_titles)
+    for key, new_section_data in new_flat.items():
+        course_id, section_id = key; new_title = new_titles[course_id]
+        old_section_data = old_flat.get(key)
+        if old_section_data is None:
+            if course_id in old_keys: change_type = "NEW_SECTION"
+            else: change_type = "NEW_CMSC4_COURSE" if course_id.startswith("CMSC4") else "NEW_COURSE_SECTION"
+            append({"type": change_type,"course": course_id,"title": new_title,"section": section_id,"data": new_section_data}); continue
+        if old_section_data == new_section_data: continue # Common steady-state case: one C-level tuple compare
+        old_open = old_section_data.open; new_open = new_section_data.open
+        if old_open == 0 and new_open > 0: append({"type": "SEATS_OPENED","course": course_id,"title": new_title,"section": section_id,"data": new_section_data, "old_val": old_open, "new_val": new_open, "field": "open"})
+        elif old_open != new_open and new_open != err and old_open != err: append({"type": "OPEN_CHANGE","course": course_id,"title": new_title,"section": section_id,"data": new_section_data, "old_val": old_open, "new_val": new_open, "field": "open"})
+        old_total = old_section_data.total; new_total = new_section_data.total
+        if old_total != new_total and new_total != err and old_total != err: append({"type": "TOTAL_CHANGE","course": course_id,"title": new_title,"section": section_id,"data": new_section_data, "old_val": old_total, "new_val": new_total, "field": "total"})
+        old_wait = old_section_data.waitlist; new_wait = new_section_data.waitlist
+        if old_wait != new_wait and new_wait != err and old_wait != err: append({"type": "WAITLIST_CHANGE","course": course_id,"title": new_title,"section": section_id,"data": new_section_data, "old_val": old_wait, "new_val": new_wait, "field": "waitlist"})
+        old_instr = old_section_data.instructor; new_instr = new_section_data.instructor
+        if old_instr != new_instr and old_instr != "Unknown": append({"type": "INSTR_CHANGE","course": course_id,"title": new_title,"section": section_id,"data": new_section_data, "old_val": old_instr, "new_val": new_instr, "field": "instructor"})
+    for key, old_section_data in old_flat.items():
+        if key in new_flat: continue
+        course_id, section_id = key
+        if course_id in new_titles: append({"type": "SECTION_REMOVED", "course": course_id, "title": old_state[course_id].get("title", "Unknown"), "section": section_id, "data": old_section_data})
     return changes
 
 # --- Formatting ---
-def get_status_emoji(open_seats, total_seats):
-    if open_seats == 0: return "🔴 "
-    elif open_seats > 0 and open_seats < total_seats: return "⏳ "
-    else: return "" # Fully open, no emoji needed
+# Status emoji keyed by (open == 0, 0 < open < total); fully open sections get no emoji
+STATUS_EMOJI = {(True, False): "🔴 ", (False, True): "⏳ ", (False, False): ""}
+# Per change type: which part of the section line it rewrites (and how), and the tag it adds
+CHANGE_FIELD_TEMPLATES = {
+    "SEATS_OPENED": ("open", "**Open: {new_val}**{diff}"), "OPEN_CHANGE": ("open", "**Open: {new_val}**{diff}"),
+    "TOTAL_CHANGE": ("total", "**Total: {new_val}**{diff}"), "WAITLIST_CHANGE": ("wait", "**Waitlist: {new_val}**{diff}"),
+    "INSTR_CHANGE": ("instr", "**Instr: {new_val}** (was {old_val})"),
+}
+CHANGE_TAGS = {"SEATS_OPENED": "🟢 OPENED", "NEW_SECTION": "➕ NEW", "NEW_COURSE_SECTION": "✨ NEW CRS", "NEW_CMSC4_COURSE": "🚨 NEW CMSC4"}
+
+def shorten_title(course_id, title):
+    max_title = 45 - len(course_id)
+    return (title[:max_title] + "...") if len(title) > max_title else title
+
+def format_removed_section(change):
+    """Formats the 'Sec ... (was ...)' part of a SECTION_REMOVED change."""
+    data = change["data"] # Use the data from the change dict
+    opn = data.open if data.open != PARSE_ERROR_DEFAULT else "?"
+    tot = data.total if data.total != PARSE_ERROR_DEFAULT else "?"
+    wl = data.waitlist if data.waitlist != PARSE_ERROR_DEFAULT else "?"
+    return f"Sec `{change['section']}` (was Open: {opn}, Total: {tot}, Waitlist: {wl}, Instr: {data.instructor})"
 
 # --- NEW: Helper function to build a lookup dict for changes ---
 def build_change_lookup(changes):
@@ -189,27 +333,16 @@ def build_change_lookup(changes):
         lookup[key].append(change)
     return lookup
 
-def format_state_message(state_data, change_lookup={}):
-    """
-    Formats the entire current state into a Discord message.
-    If change_lookup is provided, it annotates the changes.
-    """
+def format_state_message(state_data):
+    """Formats the entire current state into a Discord message (the first-run snapshot)."""
     if not state_data: return "**State Message**: No courses found/parsed."
-    
-    # Determine header based on if changes exist
-    if change_lookup:
-        header = f"**📊 Course Section Update:**"
-    else:
-        header = f"**📊 Initial State ({len(state_data)} courses monitored):**"
-        
-    lines = [header]
+    lines = [f"**📊 Initial State ({len(state_data)} courses monitored):**"]
     
     for course_id, course_data in sorted(state_data.items()):
         star = "⭐ " if course_id in STARRED_COURSES else ""
         title = course_data.get("title", "Unknown Title")
         sections = course_data.get("sections", {})
-        title_short = (title[:45-len(course_id)] + "...") if len(title) > (45-len(course_id)) else title
-        lines.append(f"\n{star}**`{course_id}`** ({title_short}):")
+        lines.append(f"\n{star}**`{course_id}`** ({shorten_title(course_id, title)}):")
         
         if course_data.get("fetch_error"):
             lines.append("  • ⚠️ *(Fetch Error: Data may be stale)*")
@@ -219,46 +352,39 @@ def format_state_message(state_data, change_lookup={}):
             lines.append("  • *(No sections found/parsed.)*")
             continue
 
-        # Format sections
         for section_id, data in sorted(sections.items()):
-            # Get changes for this specific section
-            section_changes = change_lookup.get((course_id, section_id), [])
-            lines.append(format_section_line(section_id, data, section_changes))
-
-    # --- Append removed sections to the message if there are changes ---
-    if change_lookup:
-        removed_lines = []
-        for change in changes: # This was the bug, iterating over the wrong variable
-            if change['type'] == "SECTION_REMOVED":
-                # Format removed sections using a simplified version of format_change_message
-                data = change["data"] # Use the data from the change dict
-                opn = data.get("open", "?") if data.get("open", PARSE_ERROR_DEFAULT) != PARSE_ERROR_DEFAULT else "?"
-                tot = data.get("total", "?") if data.get("total", PARSE_ERROR_DEFAULT) != PARSE_ERROR_DEFAULT else "?"
-                wl = data.get("waitlist", "?") if data.get("waitlist", PARSE_ERROR_DEFAULT) != PARSE_ERROR_DEFAULT else "?"
-                instr = data.get("instructor", "TBA")
-                star = "⭐ " if change["course"] in STARRED_COURSES else ""
-                removed_lines.append(f"{star}❌ REMOVED: `{change['course']}` Sec `{change['section']}` (was Open: {opn}, Total: {tot}, Waitlist: {wl}, Instr: {instr})")
-
-        if removed_lines:
-            lines.append("\n**Removed Sections:**")
-            lines.append("```") 
-            lines.extend(removed_lines)
-            lines.append("```")
+            lines.append(format_section_line(section_id, data, []))
             
     return "\n".join(lines)
 
 
+def format_changes_only(changes):
+    """
+    Formats only the changed sections as message lines, grouped under a header per course
+    that links back to the course on Testudo. Used for update messages instead of the full state.
+    """
+    lines = [f"**📊 Course Section Update ({len(changes)} change{'' if len(changes) == 1 else 's'}):**"]
+    current_course = None
+    for (course_id, section_id), section_changes in sorted(build_change_lookup(changes).items()):
+        first = section_changes[0]
+        if course_id != current_course:
+            current_course = course_id; star = "⭐ " if course_id in STARRED_COURSES else ""
+            course_url = SOC_COURSE_URL_TEMPLATE.format(term_id=TERM_ID, dept=course_id[:4], course_id=course_id)
+            lines.append(f"\n{star}**[`{course_id}`](<{course_url}>)** ({shorten_title(course_id, first['title'])}):")
+        if first["type"] == "SECTION_REMOVED": lines.append(f"  • ❌ REMOVED: {format_removed_section(first)}")
+        else: lines.append(format_section_line(section_id, first["data"], section_changes))
+    return lines
+
+
 # --- NEW: Helper function to format a single section line (with or without changes) ---
 def format_section_line(section_id, data, changes):
     """Formats a single section line, applying annotations if changes exist."""
-    opn = data.get("open", PARSE_ERROR_DEFAULT); tot = data.get("total", PARSE_ERROR_DEFAULT)
-    wl = data.get("waitlist", PARSE_ERROR_DEFAULT); instr = data.get("instructor", "TBA")
+    opn, tot, wl, instr = data
     
     opn_str_val = str(opn) if opn != PARSE_ERROR_DEFAULT else "?"; tot_str_val = str(tot) if tot != PARSE_ERROR_DEFAULT else "?"; wl_str_val = str(wl) if wl != PARSE_ERROR_DEFAULT else "?"
     
-    # Base strings
-    open_str = f"Open: {opn_str_val}"; total_str = f"Total: {tot_str_val}"
-    wait_str = f"Waitlist: {wl_str_val}"; instr_str = f"Instr: {instr}"
+    # Base strings, keyed by the slots CHANGE_FIELD_TEMPLATES writes into
+    parts = {"open": f"Open: {opn_str_val}", "total": f"Total: {tot_str_val}", "wait": f"Waitlist: {wl_str_val}", "instr": f"Instr: {instr}"}
     
     change_tags = [] # To store tags like [OPENED], [NEW]
     
@@ -271,26 +397,13 @@ def format_section_line(section_id, data, changes):
                 except (ValueError, TypeError): diff_str = " (?)"
 
             # Apply bolding and tags
-            if change["type"] == "SEATS_OPENED":
-                open_str = f"**Open: {new_val}**{diff_str}"; change_tags.append("🟢 OPENED")
-            elif change["type"] == "OPEN_CHANGE":
-                open_str = f"**Open: {new_val}**{diff_str}"
-            elif change["type"] == "TOTAL_CHANGE":
-                total_str = f"**Total: {new_val}**{diff_str}"
-            elif change["type"] == "WAITLIST_CHANGE":
-                wait_str = f"**Waitlist: {new_val}**{diff_str}"
-            elif change["type"] == "INSTR_CHANGE":
-                instr_str = f"**Instr: {new_val}** (was {old_val})"
-            elif change["type"] == "NEW_SECTION":
-                change_tags.append("➕ NEW")
-            elif change["type"] == "NEW_COURSE_SECTION":
-                change_tags.append("✨ NEW CRS")
-            elif change["type"] == "NEW_CMSC4_COURSE":
-                change_tags.append("🚨 NEW CMSC4")
+            ch_type = change["type"]
+            if ch_type in CHANGE_FIELD_TEMPLATES: slot, template = CHANGE_FIELD_TEMPLATES[ch_type]; parts[slot] = template.format(new_val=new_val, old_val=old_val, diff=diff_str)
+            if ch_type in CHANGE_TAGS: change_tags.append(CHANGE_TAGS[ch_type])
 
     # Determine status emoji
     status_emoji = ""
-    if opn != PARSE_ERROR_DEFAULT and tot != PARSE_ERROR_DEFAULT: status_emoji = get_status_emoji(opn, tot)
+    if opn != PARSE_ERROR_DEFAULT and tot != PARSE_ERROR_DEFAULT: status_emoji = STATUS_EMOJI[opn == 0, 0 < opn < tot]
     elif opn == 0: status_emoji = "🔴 "
     
     # Add GREEN emoji if it just opened, overriding others
@@ -300,12 +413,29 @@ def format_section_line(section_id, data, changes):
     tags_str = f" *({', '.join(change_tags)})*" if change_tags else "" # Format tags like *(OPENED, NEW)*
 
     # Assemble final line
-    return f"  • {status_emoji}`{section_id}`: {open_str}, {total_str}, {wait_str}, {instr_str}{tags_str}"
+    return f"  • {status_emoji}`{section_id}`: {parts['open']}, {parts['total']}, {parts['wait']}, {parts['instr']}{tags_str}"
 
 
 # --- Discord Notification ---
-def send_discord_notification(message_content, has_changes=False, is_initial_state=False, is_error_message=False, is_no_updates=False):
-    """Sends a pre-formatted message to Discord, handling pings and splitting."""
+async def post_discord_part(client, payload):
+    """Posts one webhook part, pausing only when Discord's rate-limit headers (or a 429) ask for it.
+    An exhausted bucket is recorded rather than slept off, so only a following post waits for the reset."""
+    global _DISCORD_READY_AT
+    wait = _DISCORD_READY_AT - time.monotonic()
+    if wait > 0: await asyncio.sleep(wait)
+    for attempt in range(1, DISCORD_MAX_ATTEMPTS + 1):
+        response = await client.post(DISCORD_WEBHOOK_URL, json=payload, timeout=15)
+        if response.status_code == 429 and attempt < DISCORD_MAX_ATTEMPTS:
+            try: retry_after = float(response.json().get("retry_after", 1))
+            except ValueError: retry_after = float(response.headers.get("Retry-After", 1))
+            print(f"Discord rate limited; retrying in {retry_after:.2f}s"); await asyncio.sleep(retry_after); continue
+        response.raise_for_status()
+        if response.headers.get("X-RateLimit-Remaining") == "0": _DISCORD_READY_AT = time.monotonic() + float(response.headers.get("X-RateLimit-Reset-After", 0))
+        return response
+
+async def send_discord_notification(client, message_content, has_changes=False, is_initial_state=False, is_error_message=False, is_no_updates=False):
+    """Sends a pre-formatted message to Discord, handling pings and splitting.
+    Parts are posted in order on the shared client, waiting only when Discord reports the bucket is empty."""
     if not DISCORD_WEBHOOK_URL: print("Discord Webhook URL not found. Skipping."); return
 
     user_ping = ""
@@ -320,40 +450,53 @@ def send_discord_notification(message_content, has_changes=False, is_initial_sta
     if not lines: return
     lines[0] = user_ping + lines[0] # Add ping to the first line
     
-    current_message_part = ""
+    # Collect lines per part and join once at each flush, tracking the running length instead of re-measuring a growing string
+    buf = []; cur_len = 0
 
-    for i, line in enumerate(lines):
+    for line in lines:
+        inc = len(line) + 1
         # Check if adding the line exceeds max length
-        if len(current_message_part) + len(line) + 1 > max_len:
-            # Send the current part if it's not empty
-            if current_message_part: messages_to_send.append(current_message_part)
-            # Start new part
-            current_message_part = line + "\n"
-        else:
-            # Add line to current part
-            current_message_part += line + "\n"
+        if cur_len + inc > max_len and buf:
+            messages_to_send.append("".join(buf)); buf = []; cur_len = 0
+        buf.append(line + "\n"); cur_len += inc
 
     # Add the last part
-    if current_message_part: messages_to_send.append(current_message_part)
+    if buf: messages_to_send.append("".join(buf))
 
-    # Send the assembled message parts
+    # Send the assembled message parts (sequentially: Discord doesn't preserve the order of concurrent posts)
     success = True
     for part in messages_to_send:
         if not part.strip(): continue
         payload = {"content": part}
         if user_ping: payload["allowed_mentions"] = {"users": [DISCORD_USER_ID_TO_PING]}
         try:
-            response = requests.post(DISCORD_WEBHOOK_URL, json=payload, timeout=15); response.raise_for_status()
-            print(f"Discord part sent! (Length: {len(part)})"); time.sleep(1.2)
-        except requests.exceptions.RequestException as e:
+            await post_discord_part(client, payload)
+            print(f"Discord part sent! (Length: {len(part)})")
+        except httpx.HTTPError as e:
             print(f"Error sending Discord part: {e}")
-            if hasattr(e, 'response') and e.response is not None: print(f"Response: {e.response.status_code} - {e.response.text}")
+            if isinstance(e, httpx.HTTPStatusError): print(f"Response: {e.response.status_code} - {e.response.text}")
             success = False; break
     if success and messages_to_send: print("All Discord parts sent.")
 
 # --- Lambda Handler ---
+def start_state_save(state):
+    """Starts the (blocking, boto3) state save in a worker thread so the S3 PUT overlaps the Discord posts; await the task for the result."""
+    return asyncio.create_task(asyncio.to_thread(save_current_state_s3, state))
+
 def lambda_handler(event, context):
     """AWS Lambda entry point."""
+    return asyncio.run(run_scraper())
+
+async def run_scraper():
+    """One scrape/compare/notify cycle. Testudo fetches and Discord posts share a single pooled AsyncClient."""
+    limits = httpx.Limits(max_connections=SECTION_FETCH_CONCURRENCY + 2, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY) # +2: search pages / Discord
+    transport = httpx.AsyncHTTPTransport(http2=True, limits=limits, retries=HTTP_CONNECT_RETRIES)
+    async with httpx.AsyncClient(transport=transport, headers={'User-Agent': USER_AGENT}, timeout=25) as client:
+        notify = functools.partial(send_discord_notification, client)
+        return await scrape_and_notify(client, notify)
+
+async def scrape_and_notify(client, notify):
+    """Loads state, scrapes Testudo, diffs, notifies Discord and saves state; returns the Lambda response dict."""
     start_time = time.time()
     print(f"Lambda function started at {time.ctime()}...")
     if not S3_BUCKET_NAME: print("🛑 ERROR: S3_BUCKET_NAME env var not set.");
@@ -361,7 +504,7 @@ def lambda_handler(event, context):
     if SEND_DISCORD_NOTIFICATION and not DISCORD_USER_ID_TO_PING: print("⚠️ WARNING: DISCORD_USER_ID_TO_PING not set. Update notifications will not ping.")
 
     old_state = load_previous_state_s3()
-    fetched_state = process_course_prefixes(COURSE_PREFIXES_TO_FETCH, SPECIFIC_3XX_COURSES, COURSES_TO_EXCLUDE, TERM_ID)
+    fetched_state = await process_course_prefixes(client, COURSE_PREFIXES_TO_FETCH, SPECIFIC_3XX_COURSES, COURSES_TO_EXCLUDE, TERM_ID)
 
     new_state = {}; fetch_errors = []; processed_courses_ids = set(fetched_state.keys())
     for course_id, data in fetched_state.items():
@@ -382,50 +525,56 @@ def lambda_handler(event, context):
              new_state[course_id] = old_data # Retain old data entirely
              if course_id not in fetch_errors: fetch_errors.append(f"{course_id} (missing from fetch)")
 
-    print("\n--- Final State Summary ---"); num_courses = len(new_state); num_sections = sum(len(d.get("sections", {})) for d in new_state.values())
+    num_courses = len(new_state); num_sections = 0; any_sections = False
+    for d in new_state.values(): # One walk for both the section count and the parse check
+        sections = d.get("sections")
+        if sections: num_sections += len(sections); any_sections = True
+    print("\n--- Final State Summary ---")
     print(f"Processed {num_courses} courses, {num_sections} sections.");
     if fetch_errors: print(f"Note: Data for {len(fetch_errors)} course(s) may be stale: {', '.join(fetch_errors)}")
     print("---------------------------\n")
 
-    parsing_successful = any(d.get("sections") for d in new_state.values()) or not processed_courses_ids
+    parsing_successful = any_sections or not processed_courses_ids
     current_status_code = 200
 
     if not parsing_successful and processed_courses_ids:
         if old_state:
             print("WARN: Parsing failed (no sections found). Skipping update.")
-            if SEND_DISCORD_NOTIFICATION: send_discord_notification("Error Alert ⚠️: Failed parsing sections. Check logs.", is_error_message=True)
+            if SEND_DISCORD_NOTIFICATION: await notify("Error Alert ⚠️: Failed parsing sections. Check logs.", is_error_message=True)
             return {'statusCode': 200, 'body': json.dumps('Parsing failed, skipped update.')}
         else:
             print("ERROR: Failed parsing sections on first run.")
-            if SEND_DISCORD_NOTIFICATION: send_discord_notification("Error Alert ⚠️: Failed parsing sections on initial run.", is_error_message=True)
+            if SEND_DISCORD_NOTIFICATION: await notify("Error Alert ⚠️: Failed parsing sections on initial run.", is_error_message=True)
             return {'statusCode': 500, 'body': json.dumps('Failed parsing on initial run.')}
 
     if not old_state:
         print("First run successful. Initializing state in S3.")
-        initial_summary = format_state_message(new_state, change_lookup={}) # Pass empty lookup
+        initial_summary = format_state_message(new_state)
+        save_task = start_state_save(new_state)
         if SEND_DISCORD_NOTIFICATION:
-             send_discord_notification(initial_summary, is_initial_state=True)
-             if fetch_errors: send_discord_notification(f"⚠️ Initial fetch failed/stale for: {', '.join(fetch_errors)}.", is_error_message=True)
-        save_success = save_current_state_s3(new_state); print("Initial state " + ("saved." if save_success else "FAILED to save."))
+             await notify(initial_summary, is_initial_state=True)
+             if fetch_errors: await notify(f"⚠️ Initial fetch failed/stale for: {', '.join(fetch_errors)}.", is_error_message=True)
+        save_success = await save_task; print("Initial state " + ("saved." if save_success else "FAILED to save."))
         if not save_success: current_status_code = 500
     else:
         changes = compare_states(old_state, new_state)
         if changes:
-            print("\n--- CHANGES DETECTED ---"); [print(format_section_line(c['section'], c['data'], [c])) for c in changes if c.get('section')]; print("------------------------\n") # Simplified console log
+            print("\n--- CHANGES DETECTED ---"); print("\n".join(format_section_line(c['section'], c['data'], [c]) for c in changes if c.get('section'))); print("------------------------\n") # Simplified console log, one write
+            save_task = start_state_save(new_state)
             if SEND_DISCORD_NOTIFICATION:
-                change_lookup = build_change_lookup(changes)
-                update_message = format_state_message(new_state, change_lookup) # Format full state with annotations
-                send_discord_notification(update_message, has_changes=True) # Send the full message, flagging it as an update
-                if fetch_errors: send_discord_notification(f"⚠️ Some course data may be stale due to fetch errors: {', '.join(fetch_errors)}.", is_error_message=True)
-            save_success = save_current_state_s3(new_state); print("Changes detected. State " + ("saved." if save_success else "FAILED to save."))
+                update_message = "\n".join(format_changes_only(changes)) # Only the changed sections, not the full state
+                await notify(update_message, has_changes=True) # Send only the changed sections, flagged as an update
+                if fetch_errors: await notify(f"⚠️ Some course data may be stale due to fetch errors: {', '.join(fetch_errors)}.", is_error_message=True)
+            save_success = await save_task; print("Changes detected. State " + ("saved." if save_success else "FAILED to save."))
             if not save_success: current_status_code = 500
         else:
             print("No significant changes detected.")
+            save_task = start_state_save(new_state) if fetch_errors else None
             if SEND_DISCORD_NOTIFICATION:
-                if SEND_NO_UPDATES_MESSAGE: send_discord_notification(f"✅ No course section updates found at {time.strftime('%H:%M:%S UTC')}.", is_no_updates=True)
-                if fetch_errors: send_discord_notification(f"⚠️ No changes, but fetch failed/stale for: {', '.join(fetch_errors)}.", is_error_message=True)
-            if fetch_errors:
-                 save_success = save_current_state_s3(new_state); print("Saving merged state " + ("succeeded." if save_success else "FAILED."))
+                if SEND_NO_UPDATES_MESSAGE: await notify(f"✅ No course section updates found at {time.strftime('%H:%M:%S UTC')}.", is_no_updates=True)
+                if fetch_errors: await notify(f"⚠️ No changes, but fetch failed/stale for: {', '.join(fetch_errors)}.", is_error_message=True)
+            if save_task:
+                 save_success = await save_task; print("Saving merged state " + ("succeeded." if save_success else "FAILED."))
                  if not save_success: current_status_code = 500
             else: print("No state save needed.")
 
@@ -443,11 +592,16 @@ if __name__ == "__main__":
          STATE_FILE = "course_state_local.json"
          def load_previous_state_local():
              try:
-                 with open(STATE_FILE, 'r') as f: return json.load(f)
-             except (FileNotFoundError, json.JSONDecodeError): return {}
+                 with open(STATE_FILE, 'rb') as f: return decode_state(f.read())
+             except (FileNotFoundError, orjson.JSONDecodeError): return {}
          def save_current_state_local(data):
              try:
-                 with open(STATE_FILE, 'w') as f: json.dump(data, f, indent=2); return True
+                 raw = encode_state(data)
+                 try:
+                     with open(STATE_FILE, 'rb') as f:
+                         if f.read() == raw: print("State identical to the local copy; skipping write."); return True
+                 except FileNotFoundError: pass
+                 with open(STATE_FILE, 'wb') as f: f.write(raw); return True
              except IOError as e: print(f"Error saving local state: {e}"); return False
          load_previous_state_s3 = load_previous_state_local
          save_current_state_s3 = save_current_state_local